@@ -0,0 +1,203 @@
+import pandas as pd
+from collections import OrderedDict
+from functools import wraps
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import var_ranking_helper as helper
+
+
+def frame_fingerprint(df):
+    """
+    Cheap content hash of a DataFrame: columns, dtypes, index and values.
+    Any edit to the frame changes the fingerprint, so cached results can't go stale
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(
+        repr((list(df.columns), [str(xx) for xx in df.dtypes], df.shape)).encode()
+    )
+    hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return hasher.hexdigest()
+
+
+def code_fingerprint(modules):
+    """
+    Hash of the source files of the modules a feature function runs, so edits to
+    the feature code invalidate on-disk results (and edits elsewhere don't)
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for fname in sorted({os.path.abspath(mm.__file__) for mm in modules}):
+        hasher.update(os.path.basename(fname).encode())
+        with open(fname, "rb") as fh:
+            hasher.update(fh.read())
+    return hasher.hexdigest()
+
+
+_UNSET = object()
+
+
+def _copy(result):
+    return result.copy() if hasattr(result, "copy") else result
+
+
+class FeatureCache:
+    """
+    LRU cache of feature tables keyed by function name, input fingerprint and
+    keyword arguments, with an optional on-disk tier
+    Args:
+        maxsize: number of results to keep in memory (0 disables the memory tier)
+        disk_dir: directory for pickled results, or None for memory only
+        max_disk_bytes: size bound for disk_dir. The least recently used pickles
+            are deleted once it is exceeded
+
+    Keys include a hash of the feature code, so results pickled by an older
+    version of the code are never returned (they age out of the disk tier)
+    """
+
+    def __init__(self, maxsize=16, disk_dir=None, max_disk_bytes=2 << 30):
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 or self.disk_dir is not None
+
+    def configure(self, maxsize=None, disk_dir=_UNSET, max_disk_bytes=None):
+        """
+        Change the cache bounds. Only the settings that are passed are changed
+        (pass disk_dir=None to turn the disk tier off)
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if disk_dir is not _UNSET:
+                self.disk_dir = disk_dir
+            if max_disk_bytes is not None:
+                self.max_disk_bytes = max_disk_bytes
+            self._evict()
+
+    def key(self, name, df, args=(), kws=None, version=""):
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(name.encode())
+        hasher.update(version.encode())
+        hasher.update(frame_fingerprint(df).encode())
+        hasher.update(repr((args, sorted((kws or {}).items()))).encode())
+        return hasher.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _evict(self):
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return True, _copy(self._results[key])
+
+        if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key), "rb") as fh:
+                result = pickle.load(fh)
+            # Mark as recently used for the disk size bound
+            os.utime(self._disk_path(key))
+            with self._lock:
+                self.disk_hits += 1
+            self._remember(key, result)
+            return True, _copy(result)
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _remember(self, key, result):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._results[key] = _copy(result)
+            self._results.move_to_end(key)
+            self._evict()
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fh:
+                pickle.dump(result, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(key))
+            self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for fname in glob.glob(os.path.join(self.disk_dir, "*.pkl")):
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._results),
+                "maxsize": self.maxsize,
+            }
+
+
+FEATURE_CACHE = FeatureCache()
+
+
+def memoize_features(func):
+    """
+    Memoize a feature function whose first argument is a haplotype DataFrame.
+    Calls in helper.reference_mode() always recompute, so the reference path is
+    never answered from results of the vectorized one
+    """
+
+    version = code_fingerprint(
+        [sys.modules[func.__module__], helper, sys.modules[__name__]]
+    )
+
+    @wraps(func)
+    def wrapper(df, *args, **kws):
+        if not FEATURE_CACHE.enabled or helper.REFERENCE_MODE:
+            return func(df, *args, **kws)
+        key = FEATURE_CACHE.key(func.__qualname__, df, args, kws, version=version)
+        found, result = FEATURE_CACHE.get(key)
+        if found:
+            return result
+        result = func(df, *args, **kws)
+        FEATURE_CACHE.put(key, result)
+        return _copy(result)
+
+    wrapper.uncached = func
+    return wrapper
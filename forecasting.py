@@ -1,11 +1,15 @@
 """
 Usage:
-  forecasting.py <infile> <outfolder> [--from_meta|--from_lineage] [--n_days_for_forecast=<n>]
+  forecasting.py <infile> <outfolder> [--from_meta|--from_lineage] [--n_days_for_forecast=<n>] [--n_months=<m>] [--n_jobs=<j>] [--sample_per_stratum=<k>] [--seed=<s>]
 
 Options:
     --from_meta     Read from metadata input. Will be inferred to be true if input is contains "metadata" but not "lineage"
     --from_lineage  Read from metadata_lineage file. Will be inferred to be true is input contains "lineage"
-    --n_days_for_forecast=<n>  Number of days to forecast [default: 90]
+    --n_days_for_forecast=<n>  Number of days to forecast. A comma separated list (e.g. 30,60,90,180) scores every horizon from a single parse of the input [default: 90]
+    --n_months=<m>  Number of most recent months to score. Also accepts a comma separated list [default: 4]
+    --n_jobs=<j>    Number of processes used to score multiple horizons. 0 uses one per horizon, up to the number of CPUs [default: 0]
+    --sample_per_stratum=<k>  Preview mode for metadata input: keep a reweighted sample of at most k sequences per country and month
+    --seed=<s>      Seed for --sample_per_stratum [default: 0]
 """
 
 import pandas as pd
@@ -15,25 +19,54 @@ import var_classification_helper as varclass
 import var_ranking_helper as helper
 import utils
 import parse_gisaid as gisaid
+from concurrent.futures import ProcessPoolExecutor
 import os
 
 today = utils.today
 
 def read_input(in_file, from_meta, from_lineage, filter_last_n_days):
+    raw_table = read_raw_input(in_file, from_meta, from_lineage)
+    return summarize_raw_input(raw_table, from_meta, from_lineage, filter_last_n_days)
+
+
+def read_raw_input(in_file, from_meta, from_lineage, max_per_stratum=None, seed=0):
+    """
+    Parse the input once, before any date filtering or aggregation.
+    max_per_stratum and seed are passed to gisaid.read_gisaid_metadata
+    """
+    if max_per_stratum is not None and not from_meta:
+        raise ValueError("Stratified sampling is only supported for metadata input")
     if from_lineage:
         print(f"Reading gisaid lineage summary: {in_file}")
-        df = read_lineage_table(in_file, filter_last_n_days=filter_last_n_days)
+        with gisaid.open_metadata(in_file, member=None) as handle:
+            df = pd.read_table(handle)
         print(f"Reading {len(df)} rows from lineage file")
         return df
     elif from_meta:
         print(f"Reading gisaid metadata summary: {in_file}")
-        return gisaid.read_gisaid_assummary(fname=in_file, filter_last_n_days=filter_last_n_days)
+        return gisaid.read_gisaid_metadata(
+            in_file, max_per_stratum=max_per_stratum, seed=seed
+        )
     else:
-        if filter_last_n_days is not None:
-            raise ValueError("Cannot filter by granular date if reading from summary file")
         print("Reading directly from summary table")
         return pd.read_csv(in_file, sep="\t")
 
+
+def summarize_raw_input(raw_table, from_meta, from_lineage, filter_last_n_days):
+    """
+    Filter a parsed input to the last n days and aggregate it into a haplotype summary
+    """
+    if from_lineage:
+        return format_lineage_table(gisaid.filter_by_date(raw_table, filter_last_n_days))
+    elif from_meta:
+        return gisaid.gisaid2haplosummary(
+            gisaid.filter_by_date(raw_table, filter_last_n_days)
+        )
+    else:
+        if filter_last_n_days is not None:
+            raise ValueError("Cannot filter by granular date if reading from summary file")
+        return raw_table
+
 def format_lineage_table(lineage_table):
     df_tmp = lineage_table[
         ["AA_Substitution", "country", "pango_lineage", "GISAID_clade", "date"]
@@ -46,32 +79,11 @@ def format_lineage_table(lineage_table):
     df_tmp = df_tmp.rename(
         columns={"AA_Substitution": "haplotype", "country": "location"}
     )
-
-    df_tmp["haplotype"] = (
-        df_tmp["haplotype"]
-        .str.replace(r"(", "", regex=False)
-        .str.replace(r")", "", regex=False)
-    )
-
-    collected_counts = df_tmp.groupby(["location", "monthdate"]).size()
-    haplotype_counts = (
-        df_tmp.groupby(
-            ["haplotype", "location", "monthdate", "pango_lineage", "GISAID_clade"]
-        )
-        .size()
-        .rename("haplotype_counts")
-    )
-    final = (
-        haplotype_counts.reset_index()
-        .set_index(["location", "monthdate"])
-        .join(collected_counts.rename("collected_counts"))
-        .reset_index()
-    )
-    final = final[final["haplotype"].str.len() > 0]
-    return final
+    return gisaid.summarize_haplotype_rows(df_tmp)
 
 def read_lineage_table(path, filter_last_n_days=None):
-    lineage_table = pd.read_table(path)
+    with gisaid.open_metadata(path, member=None) as handle:
+        lineage_table = pd.read_table(handle)
 
     lineage_table = gisaid.filter_by_date(lineage_table, filter_last_n_days)
 
@@ -107,6 +119,26 @@ def df2pred(df, months):
     return df2topscores(df, months).index
 
 
+def score_rank_agreement(scores_full, scores_approx, top_quantile=0.95):
+    """
+    Compare approximate (e.g. sampled) EpiScores to a full run
+    Returns the Spearman correlation over shared mutations and the overlap
+    (Jaccard) of the mutations above top_quantile in each
+    """
+    shared = scores_full.index.intersection(scores_approx.index)
+    spearman = scores_full[shared].rank().corr(scores_approx[shared].rank())
+    top_full = set(scores_full.loc[lambda x: x > x.quantile(top_quantile)].index)
+    top_approx = set(scores_approx.loc[lambda x: x > x.quantile(top_quantile)].index)
+    union = top_full | top_approx
+    return pd.Series(
+        {
+            "Spearman": spearman,
+            "TopOverlap": len(top_full & top_approx) / len(union) if union else np.nan,
+            "FracShared": len(shared) / len(scores_full),
+        }
+    )
+
+
 
 
 
@@ -131,21 +163,100 @@ def retrieve_hap_w_vars(mutations, df):
     return best_hap
 
 
-def write_summaries(in_file, out_folder, from_meta=False, from_lineage=False, n_days_for_forecast=None):
-    df_updatepred = read_input(
-        in_file, from_meta, from_lineage, filter_last_n_days=n_days_for_forecast)
+def _as_list(value):
+    if value is None or isinstance(value, int):
+        return [value]
+    return list(value)
 
-    haps_bymonth = (
-        df_updatepred.groupby("monthdate")["haplotype_counts"].sum().iloc[-8:]
-    )
 
-    months_updatepred = haps_bymonth.iloc[-4:].index
+def parse_int_list(value):
+    return [int(xx) for xx in str(value).split(",") if xx.strip()]
+
+
+def recent_months(df, n_months):
+    """
+    The n_months most recent months with sequences in df
+    """
+    haps_bymonth = df.groupby("monthdate")["haplotype_counts"].sum()
+    return haps_bymonth.iloc[-n_months:].index
+
 
-    scores_updatepred = df2score(df_updatepred, months_updatepred, keepall=True)
+def _score_recent_months(df_updatepred, n_months):
+    months_updatepred = recent_months(df_updatepred, n_months)
+
+    return df2score(df_updatepred, months_updatepred, keepall=True)
+
+
+def _score_month_windows(df_updatepred, month_windows):
+    return [_score_recent_months(df_updatepred, n_mo) for n_mo in month_windows]
+
+
+def replay_scores(as_of_index, dates, n_days_for_forecast=None, n_months=4):
+    """
+    Backtest: yield (date, scores) as they would have been produced on each date,
+    using only sequences submitted by then (see gisaid.AsOfIndex). The
+    n_days_for_forecast window counts back from each replay date
+    """
+    for date, df_updatepred in as_of_index.replay(
+        dates, filter_last_n_days=n_days_for_forecast
+    ):
+        yield date, _score_recent_months(df_updatepred, n_months)
+
+
+def write_summaries(
+    in_file,
+    out_folder,
+    from_meta=False,
+    from_lineage=False,
+    n_days_for_forecast=None,
+    n_months=4,
+    n_jobs=0,
+    max_per_stratum=None,
+    seed=0,
+):
+    """
+    Score every combination of forecast horizon (days) and month window.
+    The input is parsed once; each horizon is filtered and aggregated from the
+    parsed table and the scoring runs in parallel processes
+    """
+    horizons = _as_list(n_days_for_forecast)
+    month_windows = _as_list(n_months)
+    if not (from_meta or from_lineage) and any(nn is not None for nn in horizons):
+        # Fail before reading what may be a large summary table
+        raise ValueError("Cannot filter by granular date if reading from summary file")
+    raw_table = read_raw_input(
+        in_file, from_meta, from_lineage, max_per_stratum=max_per_stratum, seed=seed
+    )
+    summaries = [
+        summarize_raw_input(raw_table, from_meta, from_lineage, n_days)
+        for n_days in horizons
+    ]
+    del raw_table
+
+    # One task per horizon, so each summary is sent to the pool only once
+    n_jobs = n_jobs or min(len(horizons), os.cpu_count() or 1)
+    if n_jobs > 1 and len(horizons) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            scores_byhorizon = list(
+                pool.map(
+                    _score_month_windows,
+                    summaries,
+                    [month_windows] * len(horizons),
+                )
+            )
+    else:
+        scores_byhorizon = [_score_month_windows(df, month_windows) for df in summaries]
 
     # Write out predicted mutations with scores
     print("Writing out scores...")
-    scores_updatepred.to_csv(f"{out_folder}/scores_{today()}.csv")
+    for n_days, all_scores in zip(horizons, scores_byhorizon):
+        for n_mo, scores_updatepred in zip(month_windows, all_scores):
+            suffix = ""
+            if len(horizons) > 1:
+                suffix += f"_{n_days}d"
+            if len(month_windows) > 1:
+                suffix += f"_{n_mo}mo"
+            scores_updatepred.to_csv(f"{out_folder}/scores{suffix}_{today()}.csv")
 
 
 
@@ -176,5 +287,13 @@ if __name__ == "__main__":
         arguments["<outfolder>"],
         from_meta=arguments["--from_meta"],
         from_lineage=arguments["--from_lineage"],
-        n_days_for_forecast=int(arguments["--n_days_for_forecast"]),
+        n_days_for_forecast=parse_int_list(arguments["--n_days_for_forecast"]),
+        n_months=parse_int_list(arguments["--n_months"]),
+        n_jobs=int(arguments["--n_jobs"]),
+        max_per_stratum=(
+            int(arguments["--sample_per_stratum"])
+            if arguments["--sample_per_stratum"]
+            else None
+        ),
+        seed=int(arguments["--seed"]),
     )
@@ -0,0 +1,205 @@
+import pandas as pd
+import numpy as np
+from collections import defaultdict
+from scipy import sparse
+import json
+
+# Lineage labels that don't place a sequence in the hierarchy
+UNASSIGNED = {"", "None", "Unassigned", "unclassifiable"}
+
+
+def read_alias_key(path):
+    """
+    Read a pango-designation alias_key.json file, e.g. {"AY": "B.1.617.2", "A": ""}
+    Recombinant aliases (lists of parents) are kept as roots of their own
+    """
+    with open(path) as fh:
+        aliases = json.load(fh)
+    return {kk: vv for kk, vv in aliases.items() if isinstance(vv, str) and vv}
+
+
+def expand_lineage(lineage, aliases):
+    """
+    Expand an aliased lineage to its full name, e.g. AY.4.2 -> B.1.617.2.4.2
+    """
+    prefix, _, rest = lineage.partition(".")
+    while prefix in aliases:
+        lineage = aliases[prefix] + ("." + rest if rest else "")
+        prefix, _, rest = lineage.partition(".")
+    return lineage
+
+
+class LineageTrie:
+    """
+    Prefix trie over fully expanded Pango lineage names. Each node is a lineage
+    (or an implied ancestor of one), and its parent drops the last component
+    """
+
+    def __init__(self, lineages=(), aliases=None):
+        self.aliases = aliases or {}
+        # Longest expansions first, so the most specific alias is used for display
+        self._compress_order = sorted(
+            self.aliases.items(), key=lambda kv: len(kv[1]), reverse=True
+        )
+        self.parent = {}
+        self.children = defaultdict(set)
+        for lineage in lineages:
+            self.add(lineage)
+
+    def add(self, lineage):
+        """
+        Insert a lineage and its ancestors. Returns the expanded node name
+        """
+        node = expand_lineage(lineage, self.aliases)
+        child = node
+        while child not in self.parent:
+            parent = child.rpartition(".")[0] or None
+            self.parent[child] = parent
+            if parent is None:
+                break
+            self.children[parent].add(child)
+            child = parent
+        return node
+
+    def compress(self, node):
+        """
+        Display name for an expanded node, e.g. B.1.617.2.4 -> AY.4
+        """
+        for alias, expansion in self._compress_order:
+            if node.startswith(expansion + "."):
+                return alias + node[len(expansion) :]
+        return node
+
+    def ancestors(self, lineage):
+        """
+        The lineage itself followed by each of its ancestors, as expanded names
+        """
+        node = expand_lineage(lineage, self.aliases)
+        path = []
+        while node is not None:
+            path.append(node)
+            node = self.parent.get(node, node.rpartition(".")[0] or None)
+        return path
+
+    def descendants(self, lineage):
+        """
+        All lineages below (and including) lineage, as display names
+        """
+        stack = [expand_lineage(lineage, self.aliases)]
+        found = []
+        while stack:
+            node = stack.pop()
+            found.append(self.compress(node))
+            stack.extend(self.children.get(node, ()))
+        return found
+
+    def ancestor_matrix(self, lineages):
+        """
+        Sparse (node x lineage) matrix with a 1 wherever the node is the lineage or
+        one of its ancestors. Multiplying per-lineage totals by it rolls them up to
+        every ancestor at once. Returns the matrix and the node display names
+        """
+        node_codes = {}
+        rows, cols = [], []
+        for jj, lineage in enumerate(lineages):
+            self.add(lineage)
+            for node in self.ancestors(lineage):
+                rows.append(node_codes.setdefault(node, len(node_codes)))
+                cols.append(jj)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(node_codes), len(lineages))
+        )
+        return matrix, pd.Index([self.compress(nn) for nn in node_codes], name="lineage")
+
+
+def _assigned(df, lineage_col):
+    lineages = df[lineage_col]
+    return df[lineages.notna() & ~lineages.isin(UNASSIGNED)]
+
+
+def rollup_counts(df, trie, lineage_col="pango_lineage", value_col="haplotype_counts"):
+    """
+    Total of value_col for every lineage including all of its descendants
+    """
+    totals = _assigned(df, lineage_col).groupby(lineage_col)[value_col].sum()
+    matrix, nodes = trie.ancestor_matrix(list(totals.index))
+    return pd.Series(matrix @ totals.to_numpy(float), index=nodes, name=value_col)
+
+
+def rollup_mutation_counts(
+    df, trie, lineage_col="pango_lineage", value_col="haplotype_counts"
+):
+    """
+    lineage x mutation totals, including descendants, as a long Series indexed by
+    (lineage, mutation). Mutations are split as in count_variants_per_haplotype
+    """
+    df = _assigned(df, lineage_col).reset_index(drop=True)
+    tokens = (
+        df["haplotype"].str.split(",").explode().str.strip().rename("mutation")
+    )
+    tokens = tokens[(tokens.str.len() > 0) & ~tokens.str.contains("X", regex=False)]
+    long = (
+        pd.DataFrame(
+            {
+                "lineage": df[lineage_col].reindex(tokens.index).to_numpy(),
+                "mutation": tokens.to_numpy(),
+                "count": df[value_col].reindex(tokens.index).to_numpy(),
+            }
+        )
+        .groupby(["lineage", "mutation"])["count"]
+        .sum()
+    )
+    lin_codes, lineages = pd.factorize(long.index.get_level_values("lineage"))
+    mut_codes, mutations = pd.factorize(long.index.get_level_values("mutation"))
+    by_lineage = sparse.csr_matrix(
+        (long.to_numpy(float), (lin_codes, mut_codes)),
+        shape=(len(lineages), len(mutations)),
+    )
+    matrix, nodes = trie.ancestor_matrix(list(lineages))
+    rolled = (matrix @ by_lineage).tocoo()
+    return pd.Series(
+        rolled.data,
+        index=pd.MultiIndex.from_arrays(
+            [nodes[rolled.row], mutations[rolled.col]], names=["lineage", "mutation"]
+        ),
+        name=value_col,
+    ).sort_index()
+
+
+class LineageIndex:
+    """
+    Precomputed clade-level totals, so queries for a lineage and all of its
+    descendants (e.g. B.1.617.2 including AY.*) don't re-scan the haplotype table
+    Args:
+        df: the haplotype dataframe
+        aliases: alias dict, see read_alias_key
+    """
+
+    def __init__(self, df, aliases=None):
+        df = _assigned(df, "pango_lineage")
+        self.trie = LineageTrie(df["pango_lineage"].unique(), aliases=aliases)
+        self.counts = rollup_counts(df, self.trie)
+        self.mutation_counts = rollup_mutation_counts(df, self.trie)
+
+    @classmethod
+    def from_alias_file(cls, df, alias_path):
+        return cls(df, aliases=read_alias_key(alias_path))
+
+    def _key(self, lineage):
+        return self.trie.compress(expand_lineage(lineage, self.trie.aliases))
+
+    def count(self, lineage):
+        return self.counts.get(self._key(lineage), 0)
+
+    def variant_counts(self, lineage):
+        """
+        Same as helper.count_variants_per_haplotype, but including descendants
+        """
+        key = self._key(lineage)
+        # levels holds each lineage once; get_level_values would scan every row
+        if key not in self.mutation_counts.index.levels[0]:
+            return pd.Series(dtype=float)
+        return self.mutation_counts.loc[key]
+
+    def descendants(self, lineage):
+        return self.trie.descendants(lineage)
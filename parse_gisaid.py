@@ -1,8 +1,21 @@
 import pandas as pd
+import numpy as np
 from utils import athome
 from collections import defaultdict, Counter
 from tqdm import tqdm
 import var_ranking_helper as helper
+from contextlib import ExitStack
+import gzip
+import io
+import lzma
+import os
+import queue
+import tarfile
+import threading
+
+# Suffixes that read_gisaid_metadata can stream without unpacking to disk
+TAR_SUFFIXES = (".tar.xz", ".txz", ".tar.gz", ".tgz", ".tar.zst", ".tzst")
+COMPRESSED_SUFFIXES = TAR_SUFFIXES + (".xz", ".gz", ".zst")
 
 def get_hap_and_muts(row):
     hap = row["AA Substitutions"]
@@ -49,6 +62,50 @@ def summarize_mutations(df, months):
     if months is not None:
         assert pd.Series(months).isin(df["year-month"]).all()
         df = df[df["year-month"].isin(months)]
+    if helper.REFERENCE_MODE:
+        return _summarize_mutations_reference(df)
+
+    df = df.reset_index(drop=True)
+    tokens = (
+        df["AA Substitutions"]
+        .str.replace("(", "", regex=False)
+        .str.replace(")", "", regex=False)
+        .str.split(",")
+        .explode()
+        .str.strip()
+    )
+    # Same filtering as helper.split_mutstring
+    tokens = tokens[(tokens.str.len() > 0) & ~tokens.str.contains("X", regex=False)]
+    tokens = tokens.rename("mut").rename_axis("row").reset_index()
+
+    # Sorted mutations so the same haplotype in a different order is counted once
+    haps = (
+        tokens.sort_values(["row", "mut"])
+        .groupby("row")["mut"]
+        .agg(",".join)
+        .reindex(df.index, fill_value="")
+    )
+    country = df["Location"].str.split(" / ").str[1]
+    tokens["hap"] = haps.to_numpy()[tokens["row"]]
+    tokens["country"] = country.to_numpy()[tokens["row"]]
+
+    mut_county_df = (
+        tokens.groupby(["mut", "country"]).size().unstack(level=1).fillna(0)
+    )
+    return (
+        mut_county_df,
+        country.value_counts(sort=False),
+        _build_episcore_matrix(
+            df,
+            tokens.drop_duplicates(["mut", "hap"]).groupby("mut").size(),
+            tokens.drop_duplicates(["mut", "country"]).groupby("mut").size(),
+            tokens.groupby("mut").size(),
+            haps.unique(),
+        ),
+    )
+
+
+def _summarize_mutations_reference(df):
     all_haplos = {}
     mut_counts = Counter()
 
@@ -91,25 +148,320 @@ def summarize_mutations(df, months):
     )
 
 
-def read_gisaid_metadata(fname=athome("Data/SARS2/metadata_oct2021.tsv")):
-    print(fname)
-    df = pd.read_table(fname).dropna(subset=["AA Substitutions", "Location"])
+def is_compressed(fname):
+    return str(fname).lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def _zstd_reader(fileobj):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading .zst input requires the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+def _open_decompressed(fname, member, stack):
+    """
+    Open fname as a decompressed binary stream, registering handles on stack.
+    For tar archives, scan forward to the member whose basename matches
+    `member` (or the first .tsv member if member is None)
+    """
+    lower = str(fname).lower()
+    if lower.endswith(TAR_SUFFIXES):
+        if lower.endswith((".tar.zst", ".tzst")):
+            raw = stack.enter_context(open(fname, "rb"))
+            tar = stack.enter_context(
+                tarfile.open(fileobj=_zstd_reader(raw), mode="r|")
+            )
+        else:
+            mode = "r|xz" if lower.endswith((".tar.xz", ".txz")) else "r|gz"
+            tar = stack.enter_context(tarfile.open(fname, mode=mode))
+
+        for info in tar:
+            name = os.path.basename(info.name)
+            if info.isfile() and (
+                name == member if member is not None else name.endswith(".tsv")
+            ):
+                return tar.extractfile(info)
+        raise FileNotFoundError(f"No member {member or '*.tsv'} found in {fname}")
+    elif lower.endswith(".xz"):
+        return stack.enter_context(lzma.open(fname, "rb"))
+    elif lower.endswith(".gz"):
+        return stack.enter_context(gzip.open(fname, "rb"))
+    elif lower.endswith(".zst"):
+        raw = stack.enter_context(open(fname, "rb"))
+        return _zstd_reader(raw)
+    return stack.enter_context(open(fname, "rb"))
+
+
+class _PrefetchReader(io.RawIOBase):
+    """
+    Decompress in a background thread and hand blocks to the reader via a
+    bounded queue. lzma/zlib/zstd release the GIL while decompressing, so the
+    parser and the decompressor run concurrently and the slower stage sets
+    the pace
+    """
+
+    _EOF = object()
+
+    def __init__(self, fname, member=None, block_size=1 << 20, max_blocks=64):
+        super().__init__()
+        self._blocks = queue.Queue(maxsize=max_blocks)
+        self._buffer = b""
+        self._done = False
+        self._closing = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce, args=(fname, member, block_size), daemon=True
+        )
+        self._thread.start()
+
+    def _produce(self, fname, member, block_size):
+        try:
+            with ExitStack() as stack:
+                stream = _open_decompressed(fname, member, stack)
+                while not self._closing.is_set():
+                    block = stream.read(block_size)
+                    if not block:
+                        break
+                    self._put(block)
+        except BaseException as err:
+            self._put(err)
+        self._put(self._EOF)
+
+    def _put(self, item):
+        while not self._closing.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._buffer and not self._done:
+            item = self._blocks.get()
+            if item is self._EOF:
+                self._done = True
+            elif isinstance(item, BaseException):
+                self._done = True
+                raise item
+            else:
+                self._buffer = item
+        n = min(len(buf), len(self._buffer))
+        buf[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._closing.set()
+            self._thread.join()
+        super().close()
+
+
+def open_metadata(fname, member="metadata.tsv"):
+    """
+    Open a GISAID download for reading without unpacking it to disk.
+    Accepts plain files, metadata_tsv_{date}.tar.xz archives (and their
+    .tar.gz/.tar.zst siblings) and single-file .xz/.gz/.zst compression
+    """
+    if not is_compressed(fname):
+        return open(fname, "rb")
+    return io.BufferedReader(_PrefetchReader(fname, member=member))
+
+
+def _filter_metadata_chunk(df):
+    df = df.dropna(subset=["AA Substitutions", "Location"])
 
     # A small number of sequences are short (<5000bp)
     df = df[
         (df["Sequence length"] > 28_000)
         & df["Collection date"].str.contains("-")  # Some samples only have the year
-    ]
+    ].copy()
 
     df["year-month"] = df["Collection date"].str.split("-").str[:2].str.join("-")
     assert (df["Type"].dropna() == "betacoronavirus").all()
     return df
 
 
+def _stratum_keys(df):
+    # One stratum per (country, month), matching the locations in gisaid2haplosummary
+    country = df["Location"].str.split("/").str[1].str.strip().str.title()
+    return country + " | " + df["year-month"]
+
+
+def _sample_priority(row_numbers, seed):
+    """
+    Pseudo-random priority for each row, determined only by its position in the
+    file and the seed (so the sample doesn't depend on the chunk size)
+    """
+    seed_hash = pd.util.hash_array(np.array([seed], dtype=np.uint64))[0]
+    return pd.util.hash_array(
+        pd.util.hash_array(np.asarray(row_numbers, dtype=np.uint64)) ^ seed_hash
+    )
+
+
+class StratifiedReservoir:
+    """
+    Keep a uniform sample of at most max_per_stratum rows per (country, month)
+    while streaming chunks. Each row gets a hashed priority and the reservoir keeps
+    the lowest priorities per stratum (bottom-k sampling), which is equivalent to
+    reservoir sampling and deterministic for a given seed
+    """
+
+    def __init__(self, max_per_stratum, seed=0):
+        self.max_per_stratum = max_per_stratum
+        self.seed = seed
+        self.stratum_sizes = Counter()
+        self._reservoir = None
+
+    def add(self, chunk):
+        chunk = chunk.assign(
+            _stratum=_stratum_keys(chunk),
+            _priority=_sample_priority(chunk.index, self.seed),
+        )
+        self.stratum_sizes.update(chunk["_stratum"].value_counts().to_dict())
+        self._reservoir = (
+            pd.concat([self._reservoir, chunk])
+            .sort_values("_priority", kind="stable")
+            .groupby("_stratum", sort=False)
+            .head(self.max_per_stratum)
+        )
+
+    def sample(self):
+        """
+        Return the sampled rows with a sample_weight column (stratum size / sample
+        size), so weighted counts are unbiased estimates of the full-data counts
+        """
+        sample = self._reservoir.sort_index()
+        n_sampled = sample["_stratum"].map(sample["_stratum"].value_counts())
+        n_total = sample["_stratum"].map(pd.Series(self.stratum_sizes))
+        sample["sample_weight"] = n_total / n_sampled
+        return sample.drop(columns=["_stratum", "_priority"])
+
+
+def read_gisaid_metadata(
+    fname=athome("Data/SARS2/metadata_oct2021.tsv"),
+    chunksize=500_000,
+    max_per_stratum=None,
+    seed=0,
+):
+    """
+    Read and filter GISAID metadata in chunks
+    Args:
+        max_per_stratum: if set, keep a seeded uniform sample of at most this many
+            sequences per (country, month), with a sample_weight column for reweighting
+        seed: seed for the stratified sample
+    """
+    print(fname)
+    reservoir = None if max_per_stratum is None else StratifiedReservoir(
+        max_per_stratum, seed=seed
+    )
+    chunks = []
+    with open_metadata(fname) as handle:
+        for chunk in pd.read_table(handle, chunksize=chunksize):
+            chunk = _filter_metadata_chunk(chunk)
+            if reservoir is None:
+                chunks.append(chunk)
+            else:
+                reservoir.add(chunk)
+    if reservoir is not None:
+        return reservoir.sample()
+    return pd.concat(chunks)
+
+
+def canonical_haplotype(haplotype):
+    """
+    Sorted, comma separated mutations, so the same haplotype in a different order
+    is counted once
+    """
+    muts = (xx.strip() for xx in haplotype.replace("(", "").replace(")", "").split(","))
+    return ",".join(sorted(mm for mm in muts if mm))
+
+
+def canonicalize_haplotypes(haplotypes):
+    """
+    Map raw haplotype strings to canonical strings and 64-bit haplotype IDs
+    Each distinct raw string is canonicalized once, and rows share the resulting
+    string objects. Missing haplotypes get ID -1
+
+    Returns the per-row IDs and a table mapping each ID to its canonical string
+    """
+    codes, uniques = pd.factorize(haplotypes)
+    canonical = np.array([canonical_haplotype(hh) for hh in uniques], dtype=object)
+    unique_ids = pd.util.hash_array(canonical).view(np.int64)
+    ids = np.where(codes >= 0, unique_ids[codes], -1)
+
+    table = pd.Series(
+        canonical, index=pd.Index(unique_ids, name="haplotype_id"), name="haplotype"
+    )
+    # Raw strings that canonicalize alike share an ID; distinct strings must not
+    if table.groupby(level=0).nunique().gt(1).any():
+        raise ValueError("Haplotype ID collision")
+    return ids, table[~table.index.duplicated()]
+
+
+def haplotype_table(summary):
+    """
+    ID -> canonical haplotype string lookup for a haplotype summary
+    """
+    return (
+        summary.drop_duplicates("haplotype_id")
+        .set_index("haplotype_id")["haplotype"]
+    )
+
+
+def summarize_haplotype_rows(df_tmp):
+    """
+    Count haplotypes per location, month, lineage and clade.
+    df_tmp has one row per sequence with haplotype, location, monthdate,
+    pango_lineage, GISAID_clade and optionally sample_weight columns.
+    Haplotypes are canonicalized and grouped by their integer haplotype_id
+    """
+    df_tmp = df_tmp.copy()
+    if "sample_weight" not in df_tmp:
+        df_tmp["sample_weight"] = 1
+    ids, table = canonicalize_haplotypes(df_tmp["haplotype"])
+    df_tmp["haplotype_id"] = ids
+
+    collected_counts = df_tmp.groupby(["location", "monthdate"])["sample_weight"].sum()
+    haplotype_counts = (
+        df_tmp[df_tmp["haplotype_id"] != -1]
+        .groupby(
+            ["haplotype_id", "location", "monthdate", "pango_lineage", "GISAID_clade"]
+        )["sample_weight"]
+        .sum()
+        .rename("haplotype_counts")
+    )
+    final = (
+        haplotype_counts.reset_index()
+        .set_index(["location", "monthdate"])
+        .join(collected_counts.rename("collected_counts"))
+        .reset_index()
+    )
+    final.insert(2, "haplotype", table.reindex(final["haplotype_id"]).to_numpy())
+    final = final[final["haplotype"].str.len() > 0]
+    return final
+
+
 def gisaid2haplosummary(df, states=False):
+    """
+    Aggregate sequences into haplotype counts per location and month. If df has a
+    sample_weight column (see read_gisaid_metadata), counts are weighted sums
+    """
+    return summarize_haplotype_rows(gisaid2haplorows(df, states=states))
+
+
+def gisaid2haplorows(df, states=False):
+    """
+    One row per sequence in the column layout of the haplotype summary
+    """
     df_tmp = df[
         ["AA Substitutions", "Location", "Pango lineage", "Clade", "year-month"]
     ].copy()
+    df_tmp["sample_weight"] = df["sample_weight"] if "sample_weight" in df else 1
 
     if states:
         df_tmp = df_tmp[df_tmp["Location"].str.contains("USA")]
@@ -122,11 +474,6 @@ def gisaid2haplosummary(df, states=False):
         df_tmp["Location"] = (
             df_tmp["Location"].str.split("/").str[1].str.strip().str.title()
         )
-    df_tmp["AA Substitutions"] = (
-        df_tmp["AA Substitutions"]
-        .str.replace(r"(", "", regex=False)
-        .str.replace(r")", "", regex=False)
-    )
     df_tmp = df_tmp.rename(
         columns={
             "AA Substitutions": "haplotype",
@@ -136,23 +483,7 @@ def gisaid2haplosummary(df, states=False):
             "Location": "location",
         }
     )
-
-    collected_counts = df_tmp.groupby(["location", "monthdate"]).size()
-    haplotype_counts = (
-        df_tmp.groupby(
-            ["haplotype", "location", "monthdate", "pango_lineage", "GISAID_clade"]
-        )
-        .size()
-        .rename("haplotype_counts")
-    )
-    final = (
-        haplotype_counts.reset_index()
-        .set_index(["location", "monthdate"])
-        .join(collected_counts.rename("collected_counts"))
-        .reset_index()
-    )
-    final = final[final["haplotype"].str.len() > 0]
-    return final
+    return df_tmp
 
 
 def filter_by_date(raw_table, filter_last_n_days):
@@ -165,6 +496,140 @@ def filter_by_date(raw_table, filter_last_n_days):
         date = pd.to_datetime(raw_table[date_col])
         return raw_table[((date.max() - date).dt.days <= filter_last_n_days)]
 
+class _CumulativeCounts:
+    """
+    Running totals per integer key over days, for as-of lookups. Entries are sorted
+    by (key, day) so each lookup is one vectorized binary search over all keys
+    """
+
+    def __init__(self, keys, days, weights, n_keys):
+        totals = (
+            pd.DataFrame({"key": keys, "day": days, "weight": weights})
+            .groupby(["key", "day"])["weight"]
+            .sum()
+        )
+        cumulative = totals.groupby(level="key").cumsum()
+        key = cumulative.index.get_level_values("key").to_numpy(np.int64)
+        day = cumulative.index.get_level_values("day").to_numpy(np.int64)
+
+        self.n_keys = n_keys
+        self._first_day = day.min() if len(day) else 0
+        self._span = (day.max() - self._first_day + 2) if len(day) else 1
+        self._combined = key * self._span + (day - self._first_day)
+        self._starts = np.searchsorted(key, np.arange(n_keys))
+        self._cumulative = cumulative.to_numpy()
+
+    def as_of(self, day):
+        """
+        Total per key over all entries up to and including day
+        """
+        offset = np.clip(day - self._first_day, -1, self._span - 1)
+        query = np.arange(self.n_keys, dtype=np.int64) * self._span + offset
+        pos = np.searchsorted(self._combined, query, side="right") - 1
+        found = pos >= self._starts
+        return np.where(found, self._cumulative[np.maximum(pos, 0)], 0)
+
+
+def _to_day(dates):
+    return (
+        pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]").astype(np.int64)
+    )
+
+
+class AsOfIndex:
+    """
+    Submission-date index over GISAID metadata for nowcasting backtests.
+    Cumulative haplotype and collected counts are stored per submission day, so the
+    haplotype summary as it would have looked on any past date is the difference
+    of two cumulative lookups instead of a re-filter and re-aggregation
+    Args:
+        df: metadata from read_gisaid_metadata
+        date_col: column with the date each sequence became available
+    """
+
+    _key_cols = [
+        "haplotype_id",
+        "location",
+        "monthdate",
+        "pango_lineage",
+        "GISAID_clade",
+    ]
+
+    def __init__(self, df, date_col="Submission date"):
+        # Some samples only have the year. Omit these samples
+        df = df[df[date_col].str.contains("-", na=False)]
+        rows = gisaid2haplorows(df)
+        days = _to_day(df[date_col])
+        ids, self.haplotypes = canonicalize_haplotypes(rows["haplotype"])
+        rows["haplotype_id"] = ids
+        self.first_date = pd.Timestamp(days.min(), unit="D")
+        self.last_date = pd.Timestamp(days.max(), unit="D")
+
+        has_hap = (ids != -1) & (self.haplotypes.reindex(ids).str.len() > 0).to_numpy()
+        keyed = rows[has_hap]
+        hap_codes = keyed.groupby(self._key_cols).ngroup().to_numpy()
+        self._hap_keys = keyed.groupby(self._key_cols).size().index.to_frame(index=False)
+        valid = hap_codes >= 0
+        self._hap_counts = _CumulativeCounts(
+            hap_codes[valid],
+            days[has_hap][valid],
+            keyed["sample_weight"].to_numpy()[valid],
+            len(self._hap_keys),
+        )
+
+        collected_codes = rows.groupby(["location", "monthdate"]).ngroup().to_numpy()
+        self._collected_keys = rows.groupby(["location", "monthdate"]).size().index
+        valid = collected_codes >= 0
+        self._collected_counts = _CumulativeCounts(
+            collected_codes[valid],
+            days[valid],
+            rows["sample_weight"].to_numpy()[valid],
+            len(self._collected_keys),
+        )
+
+    def _window(self, counts, as_of, filter_last_n_days):
+        day = _to_day([as_of])[0]
+        totals = counts.as_of(day)
+        if filter_last_n_days is not None:
+            totals = totals - counts.as_of(day - filter_last_n_days - 1)
+        return totals
+
+    def summary(self, as_of, filter_last_n_days=None):
+        """
+        The gisaid2haplosummary output using only sequences submitted on or before
+        as_of (and, with filter_last_n_days, no more than that many days earlier).
+        Unlike filter_by_date, the window counts back from as_of rather than from
+        the latest submission date in the data
+        """
+        final = self._hap_keys.copy()
+        final["haplotype_counts"] = self._window(
+            self._hap_counts, as_of, filter_last_n_days
+        )
+        final = final[final["haplotype_counts"] > 0]
+
+        collected = pd.Series(
+            self._window(self._collected_counts, as_of, filter_last_n_days),
+            index=self._collected_keys,
+            name="collected_counts",
+        )
+        final = (
+            final.set_index(["location", "monthdate"])
+            .join(collected)
+            .reset_index()
+        )
+        final.insert(
+            2, "haplotype", self.haplotypes.reindex(final["haplotype_id"]).to_numpy()
+        )
+        return final.reset_index(drop=True)
+
+    def replay(self, dates, filter_last_n_days=None):
+        """
+        Yield (date, summary) for each replay date
+        """
+        for date in dates:
+            yield date, self.summary(date, filter_last_n_days=filter_last_n_days)
+
+
 def read_gisaid_assummary(
     fname=athome("Data/SARS2/metadata_oct2021.tsv"), 
     states=False,
@@ -178,7 +643,8 @@ def read_gisaid_assummary(
     return gisaid2haplosummary(df, states=states)
 
 def read_lineage_table(path):
-    lineage_table = pd.read_table(path)
+    with open_metadata(path, member=None) as handle:
+        lineage_table = pd.read_table(handle)
     df_tmp = lineage_table[["AA_Substitution", "country", "pango_lineage", "GISAID_clade", "year-month"]].copy()
     df_tmp = df_tmp.rename(
         columns={
@@ -188,24 +654,4 @@ def read_lineage_table(path):
         }
     )
 
-    df_tmp["haplotype"] = (
-        df_tmp["haplotype"].str.replace(r"(", "", regex=False).str.replace(r")", "", regex=False)
-    )
-
-
-    collected_counts = df_tmp.groupby(["location", "monthdate"]).size()
-    haplotype_counts = (
-        df_tmp.groupby(
-            ["haplotype", "location", "monthdate", "pango_lineage", "GISAID_clade"]
-        )
-        .size()
-        .rename("haplotype_counts")
-    )
-    final = (
-        haplotype_counts.reset_index()
-        .set_index(["location", "monthdate"])
-        .join(collected_counts.rename("collected_counts"))
-        .reset_index()
-    )
-    final = final[final["haplotype"].str.len() > 0]
-    return final
+    return summarize_haplotype_rows(df_tmp)
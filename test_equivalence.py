@@ -0,0 +1,180 @@
+"""
+Randomized equivalence checks between the reference (pure-Python loop) and the
+vectorized feature paths. Run directly to time both paths on larger inputs:
+
+    python test_equivalence.py [n_rows]
+"""
+import var_classification_helper as varclass
+import var_ranking_helper as helper
+import parse_gisaid as gisaid
+from feature_cache import FEATURE_CACHE
+import pandas as pd
+import numpy as np
+import sys
+import time
+
+GENES = ["Spike", "N", "NSP3", "ORF8"]
+LOCATIONS = ["USA", "United_Kingdom", "Denmark", "Brazil", "India"]
+MONTHS = ["2021-01-01", "2021-02-01", "2021-03-01", "2021-04-01"]
+
+
+def _random_mutation(rng):
+    gene = rng.choice(GENES)
+    kind = rng.integers(0, 10)
+    site = rng.integers(1, 40)
+    if kind == 0:
+        return f"{gene}_"  # gene without a mutation
+    elif kind == 1:
+        return f"{gene}_F{site}del"
+    elif kind == 2:
+        return f"N{site}-"  # deletion without a gene
+    return f"{gene}_{rng.choice(list('ADGKLNPST'))}{site}{rng.choice(list('ADGKLNPST'))}"
+
+
+def _random_haplotype(rng, mutations):
+    muts = list(rng.choice(mutations, rng.integers(1, 8)))
+    sep = rng.choice([",", ", "])
+    return sep.join(muts)
+
+
+def random_haplotype_summary(seed, n_rows=60, n_mutations=40):
+    """
+    Random haplotype summary in the gisaid2haplosummary layout, including the edge
+    cases the feature code has to handle: gene-only tokens, deletions, empty and
+    permuted haplotypes, repeated mutations and single-country mutations
+    """
+    rng = np.random.default_rng(seed)
+    mutations = [_random_mutation(rng) for _ in range(n_mutations)]
+    rows = []
+    for _ in range(n_rows):
+        location = rng.choice(LOCATIONS[: rng.integers(1, len(LOCATIONS) + 1)])
+        rows.append(
+            {
+                "location": location,
+                "monthdate": rng.choice(MONTHS),
+                "haplotype": _random_haplotype(rng, mutations),
+                "pango_lineage": rng.choice(["B.1.1.7", "AY.4", "B.1"]),
+                "GISAID_clade": rng.choice(["GR", "GK"]),
+                "haplotype_counts": int(rng.integers(1, 20)),
+            }
+        )
+    # Empty haplotypes, alongside others from the same location and month (the
+    # reference loop can't summarize a location-month with no mutations at all)
+    rows.extend({**rows[ii], "haplotype": ""} for ii in range(0, n_rows, 15))
+    # The same haplotypes with their mutations in a different order
+    rows.extend(
+        {**rows[ii], "haplotype": ",".join(reversed(rows[ii]["haplotype"].split(",")))}
+        for ii in range(1, n_rows, 10)
+    )
+    # A mutation seen in one country only
+    rows.append({**rows[0], "location": "Iceland", "haplotype": "ORF8_Q99Z"})
+    df = pd.DataFrame(rows)
+    totals = df.groupby(["location", "monthdate"])["haplotype_counts"].transform("sum")
+    df["collected_counts"] = totals + rng.integers(0, 50)
+    return df
+
+
+def random_metadata(seed, n_rows=60, n_mutations=40):
+    """
+    Random raw GISAID metadata rows for parse_gisaid.summarize_mutations
+    """
+    rng = np.random.default_rng(seed)
+    summary = random_haplotype_summary(seed, n_rows, n_mutations)
+    return pd.DataFrame(
+        {
+            "AA Substitutions": "("
+            + summary["haplotype"].str.replace(", ", ",", regex=False)
+            + np.where(rng.random(len(summary)) < 0.1, ",Spike_X12Y", "")
+            + ")",
+            "Location": "Region / " + summary["location"] + " / State",
+            "Pango lineage": summary["pango_lineage"],
+            "year-month": summary["monthdate"].str[:7],
+        }
+    )
+
+
+def _assert_same(fast, ref):
+    if isinstance(fast, tuple):
+        for ff, rr in zip(fast, ref):
+            _assert_same(ff, rr)
+        return
+    fast, ref = fast.sort_index(), ref.sort_index()
+    kws = dict(check_dtype=False, check_index_type=False, check_names=False)
+    if isinstance(fast, pd.DataFrame):
+        pd.testing.assert_frame_equal(
+            fast.sort_index(axis=1), ref.sort_index(axis=1), check_column_type=False,
+            **kws,
+        )
+    else:
+        pd.testing.assert_series_equal(fast, ref, **kws)
+
+
+def _month_summary(df):
+    summary = varclass.variant_summary_bymonth_and_country(df)
+    return summary.set_index(["monthdate", "location"], append=True)
+
+
+def _change_features(df):
+    return varclass.calculate_features(df, change_features=True)
+
+
+def compare_paths(func, df):
+    """
+    Run func on the vectorized and reference paths, check the outputs are identical
+    and return both run times in seconds. The feature cache is off for both runs,
+    so each path computes its own result
+    """
+    settings = (FEATURE_CACHE.maxsize, FEATURE_CACHE.disk_dir)
+    FEATURE_CACHE.configure(maxsize=0, disk_dir=None)
+    FEATURE_CACHE.clear()
+    try:
+        start = time.perf_counter()
+        fast = func(df)
+        fast_time = time.perf_counter() - start
+
+        with helper.reference_mode():
+            start = time.perf_counter()
+            ref = func(df)
+            ref_time = time.perf_counter() - start
+
+        stats = FEATURE_CACHE.stats()
+        assert stats["hits"] == stats["disk_hits"] == 0, "reference run hit the cache"
+    finally:
+        FEATURE_CACHE.configure(maxsize=settings[0], disk_dir=settings[1])
+        FEATURE_CACHE.clear()
+
+    assert fast is not ref
+    _assert_same(fast, ref)
+    return {"fast": fast_time, "reference": ref_time}
+
+
+CHECKS = {
+    "calculate_n_haplotypes_wherepresent": (
+        helper.calculate_n_haplotypes_wherepresent,
+        random_haplotype_summary,
+    ),
+    "variant_summary_bymonth_and_country": (_month_summary, random_haplotype_summary),
+    "calculate_change_features": (_change_features, random_haplotype_summary),
+    "summarize_mutations": (
+        lambda df: gisaid.summarize_mutations(df, None),
+        random_metadata,
+    ),
+}
+
+
+def test_equivalence():
+    for seed in range(20):
+        for name, (func, make_data) in CHECKS.items():
+            compare_paths(func, make_data(seed))
+
+
+if __name__ == "__main__":
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for name, (func, make_data) in CHECKS.items():
+        timings = compare_paths(func, make_data(0, n_rows=n_rows, n_mutations=500))
+        print(
+            f"{name}: reference {timings['reference']:.3f}s, "
+            f"fast {timings['fast']:.3f}s "
+            f"({timings['reference'] / timings['fast']:.1f}x)"
+        )
+    print("All paths match!")
@@ -0,0 +1,128 @@
+import forecasting
+import parse_gisaid as gisaid
+import pandas as pd
+import numpy as np
+import pytest
+
+METADATA_EXAMPLE = "./metadata_example.tsv"
+
+
+def _write_metadata(tmp_path):
+    """
+    Metadata for two countries over four months, submitted over ~120 days
+    """
+    lines = open(METADATA_EXAMPLE).read().splitlines()
+    header, row = lines[0], lines[1].split("\t")
+    mutations = row[14].strip("()").split(",")
+    locations = ["Europe / Denmark / X", "North America / USA / Ohio"]
+    rows = []
+    for ii in range(120):
+        row[3] = f"2021-{ii % 4 + 6:02d}-01"
+        row[4] = locations[ii % 2]
+        row[14] = "(" + ",".join(mutations[: 5 + ii % 7]) + ")"
+        row[15] = str(pd.Timestamp("2021-06-01") + pd.Timedelta(days=ii))[:10]
+        rows.append("\t".join(row))
+    fname = tmp_path / "metadata.tsv"
+    fname.write_text("\n".join([header] + rows) + "\n")
+    return str(fname)
+
+
+def test_sampling_requires_metadata():
+    # Raised before the input is read, so a missing file doesn't matter
+    for from_lineage in [True, False]:
+        with pytest.raises(ValueError, match="only supported for metadata"):
+            forecasting.read_raw_input(
+                "missing_lineage.tsv", False, from_lineage, max_per_stratum=5
+            )
+
+
+def test_score_rank_agreement():
+    scores_full = pd.Series(np.arange(20.0), index=[f"mut{ii}" for ii in range(20)])
+
+    same = forecasting.score_rank_agreement(scores_full, scores_full * 2)
+    assert same["Spearman"] == pytest.approx(1)
+    assert same["TopOverlap"] == 1 and same["FracShared"] == 1
+
+    # Half the mutations, in reverse order
+    approx = -scores_full.iloc[:10]
+    agreement = forecasting.score_rank_agreement(scores_full, approx, top_quantile=0.9)
+    assert agreement["Spearman"] == pytest.approx(-1)
+    assert agreement["FracShared"] == 0.5
+    # Top mutations are mut18, mut19 for the full scores and mut0 for the sample
+    assert agreement["TopOverlap"] == 0
+
+def test_recent_months():
+    months = pd.date_range("2021-01-01", periods=14, freq="MS").strftime("%Y-%m-%d")
+    df = pd.DataFrame({"monthdate": months, "haplotype_counts": 1})
+    # Windows longer than the old 8 month cap score every requested month
+    assert list(forecasting.recent_months(df, 12)) == list(months[-12:])
+    assert list(forecasting.recent_months(df, 4)) == list(months[-4:])
+
+
+def test_write_summaries(tmp_path):
+    in_file = _write_metadata(tmp_path)
+    out_folder = tmp_path / "out"
+    out_folder.mkdir()
+    # Two horizons use the process pool
+    forecasting.write_summaries(
+        in_file,
+        str(out_folder),
+        from_meta=True,
+        n_days_for_forecast=[30, 90],
+        n_months=[1, 2],
+        n_jobs=2,
+    )
+    today = forecasting.today()
+    expected = {
+        f"scores_{nd}d_{nm}mo_{today}.csv" for nd in [30, 90] for nm in [1, 2]
+    }
+    assert {ff.name for ff in out_folder.iterdir()} == expected
+
+    # Each file matches a serial run on its own horizon and month window
+    raw_table = forecasting.read_raw_input(in_file, True, False)
+    for nd in [30, 90]:
+        df = forecasting.summarize_raw_input(raw_table, True, False, nd)
+        for nm in [1, 2]:
+            written = pd.read_csv(
+                out_folder / f"scores_{nd}d_{nm}mo_{today}.csv", index_col=0
+            )
+            expected_scores = forecasting.df2score(
+                df, forecasting.recent_months(df, nm), keepall=True
+            )
+            pd.testing.assert_frame_equal(
+                written.sort_index(), expected_scores.sort_index(), check_dtype=False,
+                check_index_type=False,
+            )
+
+    # Single values keep the unsuffixed file name
+    single = tmp_path / "single"
+    single.mkdir()
+    forecasting.write_summaries(
+        in_file, str(single), from_meta=True, n_days_for_forecast=90
+    )
+    assert [ff.name for ff in single.iterdir()] == [f"scores_{today}.csv"]
+
+
+def test_summary_table_horizon_fails_early():
+    with pytest.raises(ValueError, match="summary file"):
+        forecasting.write_summaries(
+            "missing_summary.tsv", ".", n_days_for_forecast=[90]
+        )
+
+
+def test_replay_scores(tmp_path):
+    index = gisaid.AsOfIndex(gisaid.read_gisaid_metadata(_write_metadata(tmp_path)))
+    dates = ["2021-07-15", "2021-08-31", "2021-09-28"]
+    replayed = list(
+        forecasting.replay_scores(index, dates, n_days_for_forecast=60, n_months=2)
+    )
+    assert [date for date, _ in replayed] == dates
+
+    for date, scores in replayed:
+        df = index.summary(date, filter_last_n_days=60)
+        expected = forecasting.df2score(
+            df, forecasting.recent_months(df, 2), keepall=True
+        )
+        pd.testing.assert_frame_equal(scores, expected)
+    # Later dates see sequences submitted since
+    assert not replayed[0][1].equals(replayed[1][1])
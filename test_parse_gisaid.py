@@ -0,0 +1,132 @@
+import parse_gisaid as gisaid
+import pandas as pd
+import numpy as np
+import pytest
+import gzip
+import tarfile
+
+METADATA_EXAMPLE = "./metadata_example.tsv"
+
+
+def _make_tar_xz(tmp_path):
+    archive = tmp_path / "metadata_tsv_2021_10_19.tar.xz"
+    with tarfile.open(archive, "w:xz") as tar:
+        tar.add("./README.md", arcname="readme.txt")
+        tar.add(METADATA_EXAMPLE, arcname="metadata.tsv")
+    return str(archive)
+
+
+def _make_gz(tmp_path):
+    archive = tmp_path / "metadata.tsv.gz"
+    with open(METADATA_EXAMPLE, "rb") as src, gzip.open(archive, "wb") as dst:
+        dst.write(src.read())
+    return str(archive)
+
+
+def test_read_compressed_metadata(tmp_path):
+    expected = gisaid.read_gisaid_metadata(METADATA_EXAMPLE)
+    for fname in _make_tar_xz(tmp_path), _make_gz(tmp_path):
+        pd.testing.assert_frame_equal(gisaid.read_gisaid_metadata(fname), expected)
+
+
+def test_open_metadata_missing_member(tmp_path):
+    archive = _make_tar_xz(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        with gisaid.open_metadata(archive, member="lineage.tsv") as handle:
+            handle.read()
+
+
+def _write_many_rows(tmp_path, n_rows=400):
+    lines = open(METADATA_EXAMPLE).read().splitlines()
+    header, row = lines[0], lines[1].split("\t")
+    locations = ["Europe / Denmark / X", "North America / USA / Ohio"]
+    rows = []
+    for ii in range(n_rows):
+        row[4] = locations[ii % 2]
+        row[3] = f"2021-{ii % 3 + 8:02d}-01"
+        rows.append("\t".join(row))
+    fname = tmp_path / "metadata.tsv"
+    fname.write_text("\n".join([header] + rows) + "\n")
+    return str(fname)
+
+
+def test_stratified_sample(tmp_path):
+    fname = _write_many_rows(tmp_path)
+    full = gisaid.read_gisaid_metadata(fname)
+    sample = gisaid.read_gisaid_metadata(fname, chunksize=37, max_per_stratum=10, seed=3)
+
+    # Deterministic for a seed, regardless of chunking
+    again = gisaid.read_gisaid_metadata(fname, chunksize=100, max_per_stratum=10, seed=3)
+    pd.testing.assert_frame_equal(sample, again)
+    assert not sample.index.equals(
+        gisaid.read_gisaid_metadata(fname, max_per_stratum=10, seed=4).index
+    )
+
+    assert len(sample) == 6 * 10
+    assert sample.index.isin(full.index).all()
+
+    # Reweighted counts recover the full-data totals
+    summary_full = gisaid.gisaid2haplosummary(full)
+    summary_sample = gisaid.gisaid2haplosummary(sample)
+    assert summary_sample["haplotype_counts"].sum() == summary_full["haplotype_counts"].sum()
+    pd.testing.assert_series_equal(
+        summary_sample.groupby(["location", "monthdate"])["collected_counts"].first(),
+        summary_full.groupby(["location", "monthdate"])["collected_counts"].first(),
+        check_dtype=False,
+    )
+
+
+def test_canonical_haplotype_ids():
+    df_tmp = pd.DataFrame(
+        {
+            "haplotype": ["(Spike_D614G,N_R203K)", "N_R203K, Spike_D614G", "()"],
+            "location": "Denmark",
+            "monthdate": "2021-10",
+            "pango_lineage": "AY.4",
+            "GISAID_clade": "GK",
+        }
+    )
+    summary = gisaid.summarize_haplotype_rows(df_tmp)
+
+    # Permuted haplotypes are one group; the empty one only counts towards the total
+    assert len(summary) == 1
+    row = summary.iloc[0]
+    assert row["haplotype"] == "N_R203K,Spike_D614G"
+    assert row["haplotype_counts"] == 2 and row["collected_counts"] == 3
+    assert gisaid.haplotype_table(summary)[row["haplotype_id"]] == row["haplotype"]
+
+
+def test_haplotype_id_collision(monkeypatch):
+    monkeypatch.setattr(
+        gisaid.pd.util, "hash_array", lambda values: np.zeros(len(values), np.uint64)
+    )
+    # Permutations of one haplotype share an ID without being a collision
+    ids, table = gisaid.canonicalize_haplotypes(pd.Series(["A,B", "B, A"]))
+    assert list(ids) == [0, 0] and list(table) == ["A,B"]
+    with pytest.raises(ValueError, match="collision"):
+        gisaid.canonicalize_haplotypes(pd.Series(["A,B", "C"]))
+
+
+def test_as_of_index(tmp_path):
+    fname = _write_many_rows(tmp_path, n_rows=90)
+    full = gisaid.read_gisaid_metadata(fname)
+    full["Submission date"] = pd.Timestamp("2021-10-01") + pd.to_timedelta(
+        (full.index * 7) % 60, unit="D"
+    )
+    full["Submission date"] = full["Submission date"].dt.strftime("%Y-%m-%d")
+    index = gisaid.AsOfIndex(full)
+
+    keys = ["location", "monthdate", "haplotype_id", "pango_lineage", "GISAID_clade"]
+    for as_of, n_days in [("2021-10-29", None), ("2021-11-12", 20), ("2021-11-29", 0)]:
+        submitted = pd.to_datetime(full["Submission date"])
+        age = (pd.Timestamp(as_of) - submitted).dt.days
+        visible = full[(age >= 0) & ((age <= n_days) if n_days is not None else True)]
+        expected = gisaid.gisaid2haplosummary(visible)
+        summary = index.summary(as_of, filter_last_n_days=n_days)
+        pd.testing.assert_frame_equal(
+            summary[expected.columns].sort_values(keys).reset_index(drop=True),
+            expected.sort_values(keys).reset_index(drop=True),
+            check_dtype=False,
+        )
+
+    assert len(index.summary("2021-01-01")) == 0
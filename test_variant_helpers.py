@@ -1,5 +1,13 @@
 import var_classification_helper as varclass
+import var_ranking_helper as varhelper
+from feature_cache import FEATURE_CACHE, code_fingerprint
+import var_linkage_helper as linkage
+import lineage_helper
+import json
+from types import SimpleNamespace
 import pandas as pd
+import numpy as np
+import pytest
 
 def read_test_data():
     df = pd.read_csv("./test_data_haplos.csv")
@@ -65,6 +73,196 @@ def test_features():
     _test_counts(df_train, features_train)
 
 
+@pytest.fixture
+def feature_cache(tmp_path):
+    """
+    FEATURE_CACHE with a small memory tier and a temporary disk tier, restored
+    afterwards even if the test fails
+    """
+    settings = (FEATURE_CACHE.maxsize, FEATURE_CACHE.disk_dir)
+    FEATURE_CACHE.clear()
+    FEATURE_CACHE.configure(maxsize=2, disk_dir=str(tmp_path))
+    try:
+        yield FEATURE_CACHE
+    finally:
+        FEATURE_CACHE.configure(maxsize=settings[0], disk_dir=settings[1])
+        FEATURE_CACHE.clear()
+
+
+def test_feature_cache(feature_cache, tmp_path):
+    _, df_train, _ = read_test_data()
+
+    first = varclass.calculate_features(df_train)
+    second = varclass.calculate_features(df_train)
+    pd.testing.assert_frame_equal(first, second)
+    assert feature_cache.stats()["hits"] == 1
+
+    # Changing the input must not return the stale result
+    df_edit = df_train.copy()
+    df_edit["haplotype_counts"] = df_edit["haplotype_counts"] * 2
+    edited = varclass.calculate_features(df_edit)
+    assert feature_cache.stats()["misses"] == 2
+    pd.testing.assert_frame_equal(edited, varclass.calculate_features.uncached(df_edit))
+
+    # Results evicted from memory come back from disk
+    feature_cache.clear()
+    varclass.calculate_features(df_train)
+    assert feature_cache.stats()["disk_hits"] == 1
+
+    # Changing only the memory bound keeps the disk tier
+    feature_cache.configure(maxsize=0)
+    assert feature_cache.disk_dir == str(tmp_path)
+
+    # Results from another version of the feature code are not reused
+    key = feature_cache.key("calculate_features", df_train, version="a")
+    assert key != feature_cache.key("calculate_features", df_train, version="b")
+
+    # The version only depends on the modules the feature code runs
+    module = tmp_path / "features.py"
+    module.write_text("x = 1\n")
+    version = code_fingerprint([SimpleNamespace(__file__=str(module))])
+    (tmp_path / "test_features.py").write_text("x = 2\n")
+    assert version == code_fingerprint([SimpleNamespace(__file__=str(module))])
+    module.write_text("x = 2\n")
+    assert version != code_fingerprint([SimpleNamespace(__file__=str(module))])
+
+    # The reference path is never answered from cached vectorized results
+    feature_cache.configure(maxsize=2)
+    stats = feature_cache.stats()
+    with varhelper.reference_mode():
+        varclass.calculate_features(df_train)
+    assert feature_cache.stats() == stats
+
+    # The disk tier is trimmed to its size bound
+    feature_cache.configure(max_disk_bytes=0)
+    varclass.calculate_features(df_edit.assign(haplotype_counts=1))
+    assert len(list(tmp_path.glob("*.pkl"))) == 0
+
+
+def test_linkage():
+    _, df_train, _ = read_test_data()
+    pairs = linkage.linkage_table(df_train, min_support=2)
+    assert len(pairs) > 0 and (pairs["N_Both"] >= 2).all()
+
+    hap_sets = df_train["haplotype"].str.split(", ").apply(set)
+    for _, row in pairs.head(20).iterrows():
+        has_a = hap_sets.apply(lambda x: row["Mut_A"] in x)
+        has_b = hap_sets.apply(lambda x: row["Mut_B"] in x)
+        counts = df_train["haplotype_counts"]
+        assert row["N_Both"] == counts[has_a & has_b].sum()
+        assert row["N_A"] == counts[has_a].sum()
+        assert row["N_B"] == counts[has_b].sum()
+
+    top1 = linkage.linkage_table(df_train, min_support=2, topk=1)
+    assert set(zip(top1["Mut_A"], top1["Mut_B"])) <= set(
+        zip(pairs["Mut_A"], pairs["Mut_B"])
+    )
+
+
+def test_growth_rates():
+    df, _, _ = read_test_data()
+    month_summary = varclass.variant_summary_bymonth_and_country(df)
+    collected = df.groupby(["location", "monthdate"])["collected_counts"].first()
+    growth = varclass.fit_growth_rates(month_summary, collected)
+
+    # Compare the batched solve against a per-series weighted polyfit
+    for (variant, location), row in growth.dropna().head(10).iterrows():
+        totals = collected.loc[location]
+        counts = (
+            month_summary[month_summary["location"] == location]
+            .loc[[variant]]
+            .set_index("monthdate")["NCounts"]
+            .reindex(totals.index)
+            .fillna(0)
+        )
+        frac = (counts + 0.5) / (totals + 1)
+        x = pd.to_datetime(totals.index).to_period("M").asi8
+        weights = totals * frac * (1 - frac)
+        slope = np.polyfit(x, np.log(frac / (1 - frac)), 1, w=np.sqrt(weights))[0]
+        assert np.isclose(row["Growth_Rate"], slope)
+
+    features = varclass.calculate_change_features(df)
+    assert {"Growth_Rate", "Growth_SE", "Growth_Rate_Top1"} <= set(features.columns)
+
+    # A variant listed twice in every haplotype is counted more often than the
+    # location sequenced; its fraction is capped rather than turning the logit NaN
+    dup = pd.DataFrame(
+        {
+            "location": "USA",
+            "monthdate": ["2021-01-01", "2021-02-01", "2021-03-01"],
+            "haplotype": "Spike_N501Y, Spike_N501Y",
+            "haplotype_counts": [3, 5, 8],
+            "collected_counts": [3, 5, 8],
+        }
+    )
+    dup_summary = varclass.variant_summary_bymonth_and_country(dup)
+    dup_collected = dup.set_index(["location", "monthdate"])["collected_counts"]
+    dup_growth = varclass.fit_growth_rates(dup_summary, dup_collected)
+    assert np.isfinite(dup_growth[["Growth_Rate", "Growth_SE"]].to_numpy()).all()
+
+
+def test_lineage_rollup(tmp_path):
+    alias_path = tmp_path / "alias_key.json"
+    alias_path.write_text(
+        json.dumps(
+            {"A": "", "B": "", "AY": "B.1.617.2", "XA": ["B.1.1.7", "B.1.177"]}
+        )
+    )
+    aliases = lineage_helper.read_alias_key(alias_path)
+    assert lineage_helper.expand_lineage("AY.4.2", aliases) == "B.1.617.2.4.2"
+
+    df = pd.DataFrame(
+        {
+            "pango_lineage": ["B.1.617.2", "AY.4", "AY.4.2", "B.1.1.7", "XA", "None"],
+            "haplotype": [
+                "Spike_P681R",
+                "Spike_P681R, N_G215C",
+                "N_G215C",
+                "Spike_N501Y",
+                "Spike_N501Y",
+                "Spike_D614G",
+            ],
+            "haplotype_counts": [5, 3, 2, 7, 1, 4],
+        }
+    )
+    index = lineage_helper.LineageIndex.from_alias_file(df, alias_path)
+
+    # B.1.617.2 includes AY.*, B.1 includes everything but the recombinant
+    assert index.count("B.1.617.2") == 10
+    assert index.count("AY.4") == 5
+    assert index.count("B.1") == 17
+    assert index.count("XA") == 1
+    assert set(index.descendants("B.1.617.2")) == {"B.1.617.2", "AY.4", "AY.4.2"}
+
+    delta = varhelper.count_variants_per_haplotype(df, "B.1.617.2", lineage_index=index)
+    assert delta.to_dict() == {"N_G215C": 5, "Spike_P681R": 8}
+    assert index.variant_counts("B.1.351").empty
+
+
+def test_features_by_location():
+    df, _, _ = read_test_data()
+    by_location = varclass.calculate_features_by(df, by="location")
+    assert list(by_location.columns[:2]) == ["location", "variant"]
+
+    for location, expected in by_location.groupby("location"):
+        features = varclass.calculate_features.uncached(df[df["location"] == location])
+        pd.testing.assert_frame_equal(
+            expected.set_index("variant")[features.columns].sort_index(),
+            features.sort_index(),
+            check_names=False,
+            check_index_type=False,
+        )
+        pct = features[varclass.EPI_COLUMNS].rank(pct=True)
+        pd.testing.assert_frame_equal(
+            expected.set_index("variant")[[f"{cc}_Pct" for cc in pct]]
+            .set_axis(pct.columns, axis=1)
+            .sort_index(),
+            pct.sort_index(),
+            check_names=False,
+            check_index_type=False,
+        )
+
+
 def count_variant(df, variant, countries=["United_Kingdom", "USA"]):
     var_count = (
         df[df["haplotype"].str.contains(variant) & df["location"].isin(countries)]
@@ -75,4 +273,4 @@ def count_variant(df, variant, countries=["United_Kingdom", "USA"]):
 
 if __name__ == "__main__":
     test_features()
-    print("All tests pass!")
\ No newline at end of file
+    print("All tests pass!")
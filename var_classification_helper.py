@@ -1,4 +1,5 @@
 import var_ranking_helper as helper
+from feature_cache import memoize_features
 import pandas as pd
 import numpy as np
 
@@ -60,6 +61,15 @@ def variant_summary_bymonth_and_country(df):
     """
     Calculate summaries per country per month
     """
+    if helper.REFERENCE_MODE:
+        return _variant_summary_bymonth_and_country_reference(df)
+    summary = helper.haplotype_features(df, by=["monthdate", "location"])
+    summary = summary.reset_index(["monthdate", "location"])
+    summary.index.name = None
+    return summary[helper.FEATURE_COLUMNS + ["monthdate", "location"]]
+
+
+def _variant_summary_bymonth_and_country_reference(df):
     all_tmp_c = []
     for (kk, ll), dd in df.groupby(["monthdate", "location"]):
         tmp = pd.concat(helper.calculate_n_haplotypes_wherepresent(dd), axis=1)
@@ -101,7 +111,133 @@ def get_topn(dd, higher_better=True, topn=3):
     return dd
 
 
-def calculate_change_features(df_before, topn_fc=3, topn_delta=2, higher_better=True):
+def _month_ordinals(months):
+    return pd.to_datetime(pd.Index(months).astype(str)).to_period("M").asi8
+
+
+def fit_growth_rates(month_summary, collected_counts, pseudocount=0.5):
+    """
+    Fit a weighted log-linear (logit) growth rate per month to Frac_Vars for every
+    (variant, location) series at once
+    Args:
+        month_summary: output of variant_summary_bymonth_and_country
+        collected_counts: number of sequences collected per (location, monthdate)
+        pseudocount: added to the variant counts so months with no observations
+            still contribute to the fit
+
+    Each series covers the months in which its location collected sequences.
+    Points are weighted by the binomial precision of the logit, N*p*(1-p), and the
+    standard error is inflated by the residual dispersion when it exceeds 1.
+    Series observed in fewer than two months have NaN rate and SE
+    """
+    counts = (
+        month_summary.set_index(["monthdate", "location"], append=True)["NCounts"]
+        .unstack(level="monthdate")
+        .fillna(0)
+    )
+    counts = counts.reindex(columns=sorted(counts.columns))
+    totals = (
+        collected_counts.unstack(level="monthdate")
+        .reindex(columns=counts.columns)
+        .reindex(counts.index.get_level_values("location"))
+        .fillna(0)
+        .to_numpy(float)
+    )
+    # A variant listed twice in a haplotype can be counted more often than sequenced
+    n_var = np.minimum(counts.to_numpy(float), totals)
+
+    x = _month_ordinals(counts.columns).astype(float)
+    x = x - x.mean()
+    observed = totals > 0
+    frac = (n_var + pseudocount) / (totals + 2 * pseudocount)
+    y = np.log(frac / (1 - frac))
+    w = np.where(observed, totals * frac * (1 - frac), 0)
+
+    sw = w.sum(axis=1)
+    sx = w @ x
+    sy = (w * y).sum(axis=1)
+    sxx = w @ (x ** 2)
+    sxy = (w * y) @ x
+    n_months = observed.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = sw * sxx - sx ** 2
+        valid = (n_months >= 2) & (det > 0)
+        rate = np.where(valid, (sw * sxy - sx * sy) / det, np.nan)
+        intercept = (sy - rate * sx) / sw
+        resid = y - intercept[:, None] - rate[:, None] * x[None, :]
+        dispersion = np.where(
+            n_months > 2, (w * resid ** 2).sum(axis=1) / (n_months - 2), 1
+        )
+        se = np.where(valid, np.sqrt(np.maximum(dispersion, 1) * sw / det), np.nan)
+
+    return pd.DataFrame(
+        {"Growth_Rate": rate, "Growth_SE": se, "N_Months": n_months},
+        index=counts.index,
+    )
+
+
+def _topn_table(values, topn, higher_better=True, prefix=""):
+    """
+    Vectorized get_topn: the topn values per variant as Top1..TopN columns
+    """
+    values = values.dropna().sort_values(ascending=not higher_better)
+    variant = values.index.get_level_values(0)
+    rank = values.groupby(variant, sort=False).cumcount()
+    keep = (rank < topn).to_numpy()
+    table = pd.Series(
+        values.to_numpy()[keep],
+        index=pd.MultiIndex.from_arrays(
+            [variant[keep], [f"Top{rr + 1}" for rr in rank[keep]]]
+        ),
+    ).unstack(level=1)
+    return table.add_prefix(prefix)
+
+
+def summarize_growth_rates(growth, topn=3, higher_better=True):
+    """
+    Per-variant growth features: inverse-variance pooled rate and SE across
+    locations, plus the rates in the topn locations
+    """
+    growth = growth.dropna(subset=["Growth_Rate", "Growth_SE"])
+    precision = 1 / growth["Growth_SE"] ** 2
+    variant = growth.index.get_level_values(0)
+    total_precision = precision.groupby(variant).sum()
+    pooled = pd.DataFrame(
+        {
+            "Growth_Rate": (growth["Growth_Rate"] * precision)
+            .groupby(variant)
+            .sum()
+            / total_precision,
+            "Growth_SE": 1 / np.sqrt(total_precision),
+        }
+    )
+    return pooled.join(
+        _topn_table(
+            growth["Growth_Rate"], topn, higher_better=higher_better,
+            prefix="Growth_Rate_",
+        ).fillna(0)
+    )
+
+
+def _country_topn(values, topn, higher_better):
+    """
+    Top N per-country values for each variant, as Top1..TopN columns
+    """
+    if helper.REFERENCE_MODE:
+        return (
+            values.groupby(level=0)
+            .apply(get_topn, topn=topn, higher_better=higher_better)
+            .unstack(level=1)
+            .fillna(0)
+        )
+    return _topn_table(values, topn, higher_better=higher_better).fillna(0)
+
+
+@memoize_features
+def calculate_change_features(
+    df_before, topn_fc=3, topn_delta=2, higher_better=True, topn_growth=3
+):
     """
     Extract rate of change featurizations
     """
@@ -117,29 +253,60 @@ def calculate_change_features(df_before, topn_fc=3, topn_delta=2, higher_better=
             .fillna(0)
         )
 
-        df_change = (
-            get_total_fc(data_bycountry)
-            .groupby(level=0)
-            .apply(get_topn, topn=topn_fc, higher_better=higher_better)
-            .unstack(level=1)
-            .fillna(0)
-            .add_prefix("FC_")
-        )
-        df_change2 = (
-            get_total_delta(data_bycountry)
-            .groupby(level=0)
-            .apply(get_topn, topn=topn_delta, higher_better=higher_better)
-            .unstack(level=1)
-            .fillna(0)
-            .add_prefix("Delta_")
-        )
+        df_change = _country_topn(
+            get_total_fc(data_bycountry), topn_fc, higher_better
+        ).add_prefix("FC_")
+        df_change2 = _country_topn(
+            get_total_delta(data_bycountry), topn_delta, higher_better
+        ).add_prefix("Delta_")
         feature_df_change.append((df_change.join(df_change2).add_prefix(ff + "_")))
 
+    if topn_growth is not None:
+        collected_counts = df_before.groupby(["location", "monthdate"])[
+            "collected_counts"
+        ].first()
+        growth = fit_growth_rates(month_summary, collected_counts)
+        feature_df_change.append(
+            summarize_growth_rates(
+                growth, topn=topn_growth, higher_better=higher_better
+            )
+        )
+
     feature_df_change = pd.concat(feature_df_change, axis=1)
 
     return feature_df_change
 
 
+EPI_COLUMNS = ["Frac_HaplosWherePresent", "N_Countries", "Frac_Vars"]
+
+
+@memoize_features
+def calculate_features_by(df_before, by="location"):
+    """
+    EpiScore and its components for every geography in one grouped pass
+    Args:
+        df_before: the haplotype dataframe
+        by: column(s) to rank within, e.g. "location" or a continent column
+
+    Each group gets the same values as calculate_features on that group alone,
+    plus the within-group percentile rank of each component as <component>_Pct.
+    Returns a long table with one row per (*by, variant)
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    features = helper.haplotype_features(df_before, by=by)[EPI_COLUMNS]
+    groups = features.groupby(level=by, sort=False)
+
+    pct = groups[EPI_COLUMNS].rank(pct=True)
+    features["EpiScore"] = (10 ** pct).mean(axis=1)
+    features["EpiZScore"] = (
+        (features[EPI_COLUMNS] - groups[EPI_COLUMNS].transform("mean"))
+        / groups[EPI_COLUMNS].transform("std")
+    ).mean(axis=1)
+    features[[f"{cc}_Pct" for cc in EPI_COLUMNS]] = pct.to_numpy()
+    return features.reset_index()
+
+
+@memoize_features
 def calculate_features(df_before, change_features=False, classify=True, **kws):
     """
     Calculate and join cross-sectional and rate-of-change features
@@ -149,7 +316,7 @@ def calculate_features(df_before, change_features=False, classify=True, **kws):
     )
 
     if classify:
-        epi_cols = ["Frac_HaplosWherePresent", "N_Countries", "Frac_Vars"]
+        epi_cols = EPI_COLUMNS
         feature_df_cross = feature_df_cross[epi_cols]
         feature_df_cross["EpiScore"] = (10 ** feature_df_cross.rank(pct=True)).mean(
             axis=1
@@ -0,0 +1,140 @@
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+
+def _incidence_indices(haplotypes):
+    """
+    Tokenize each distinct haplotype once (as in helper.split_mutstring) into CSR
+    column indices, assigning mutation codes on first sight
+    """
+    mut_codes = {}
+    indices = []
+    indptr = [0]
+    for hh in haplotypes:
+        codes = {
+            mut_codes.setdefault(mm, len(mut_codes))
+            for mm in (xx.strip() for xx in hh.split(","))
+            # Skip the case where they didn't put in the mutation after the gene name
+            if mm and "X" not in mm and mm[-1] != "_"
+        }
+        indices.extend(codes)
+        indptr.append(len(indices))
+    return np.array(indices, dtype=np.int64), np.array(indptr), list(mut_codes)
+
+
+def haplotype_incidence(df, weight_col="haplotype_counts"):
+    """
+    Build the haplotype x mutation incidence matrix
+    Args:
+        df: the haplotype dataframe
+        weight_col: column used to weight each row, or None to count rows
+
+    Returns the (n_haplotypes x n_mutations) binary CSR matrix, the per-haplotype
+    weights and the mutation labels for the columns.
+    Identical haplotype strings are collapsed before tokenizing, so the cost
+    scales with the number of distinct haplotypes rather than rows
+    """
+    hap_codes, haplotypes = pd.factorize(df["haplotype"])
+    row_weights = (
+        np.ones(len(df)) if weight_col is None else df[weight_col].to_numpy(float)
+    )
+    weights = np.bincount(hap_codes, weights=row_weights, minlength=len(haplotypes))
+
+    indices, indptr, mutations = _incidence_indices(haplotypes)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(indices)), indices, indptr),
+        shape=(len(haplotypes), len(mutations)),
+    )
+    return incidence, weights, pd.Index(mutations, name="mutation")
+
+
+def cooccurrence_matrix(df, min_count=1, weight_col="haplotype_counts"):
+    """
+    Weighted mutation x mutation co-occurrence counts as a sparse product H^T W H
+    Args:
+        df: the haplotype dataframe
+        min_count: drop mutations observed fewer than this many times. No pair can
+            have more support than either of its mutations, so this prunes the
+            product without changing any pair above the threshold
+        weight_col: see haplotype_incidence
+
+    Returns the symmetric CSR matrix (diagonal = per-mutation counts), the
+    mutation labels and the total weight
+    """
+    incidence, weights, mutations = haplotype_incidence(df, weight_col=weight_col)
+    mut_counts = np.asarray(incidence.T @ weights).ravel()
+
+    keep = np.flatnonzero(mut_counts >= min_count)
+    incidence = incidence[:, keep]
+    cooc = (incidence.T @ sparse.diags(weights) @ incidence).tocsr()
+    return cooc, mutations[keep], weights.sum()
+
+
+def _topk_mask(rows, counts, topk):
+    """
+    Mark entries that are among the topk largest counts within their row
+    """
+    order = np.lexsort((-counts, rows))
+    sorted_rows = rows[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_rows)) + 1]
+    row_start = np.repeat(starts, np.diff(np.r_[starts, len(sorted_rows)]))
+    mask = np.zeros(len(rows), dtype=bool)
+    mask[order] = (np.arange(len(order)) - row_start) < topk
+    return mask
+
+
+def linkage_table(df, min_support=10, topk=None, weight_col="haplotype_counts"):
+    """
+    Report co-occurring mutation pairs with conditional frequencies and linkage
+    Args:
+        df: the haplotype dataframe
+        min_support: minimum weighted co-occurrence count for a pair to be reported
+        topk: if set, only keep pairs that are among the topk partners of at
+            least one of the two mutations
+        weight_col: see haplotype_incidence
+
+    Columns:
+        N_Both, N_A, N_B: weighted counts of the pair and of each mutation
+        Frac_BgivenA, Frac_AgivenB: conditional frequencies
+        D, R2: linkage disequilibrium and its squared correlation
+    """
+    cooc, mutations, total = cooccurrence_matrix(
+        df, min_count=min_support, weight_col=weight_col
+    )
+    mut_counts = cooc.diagonal()
+
+    pairs = sparse.triu(cooc, k=1).tocoo()
+    keep = pairs.data >= min_support
+    rows, cols, both = pairs.row[keep], pairs.col[keep], pairs.data[keep]
+
+    if topk is not None:
+        # A pair survives if either mutation ranks it among its topk partners
+        mask = _topk_mask(np.r_[rows, cols], np.r_[both, both], topk)
+        mask = mask[: len(rows)] | mask[len(rows) :]
+        rows, cols, both = rows[mask], cols[mask], both[mask]
+
+    n_a, n_b = mut_counts[rows], mut_counts[cols]
+    p_a, p_b, p_ab = n_a / total, n_b / total, both / total
+    dis = p_ab - p_a * p_b
+    denom = p_a * (1 - p_a) * p_b * (1 - p_b)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = np.where(denom > 0, dis ** 2 / denom, np.nan)
+
+    return (
+        pd.DataFrame(
+            {
+                "Mut_A": mutations[rows],
+                "Mut_B": mutations[cols],
+                "N_Both": both,
+                "N_A": n_a,
+                "N_B": n_b,
+                "Frac_BgivenA": both / n_a,
+                "Frac_AgivenB": both / n_b,
+                "D": dis,
+                "R2": r2,
+            }
+        )
+        .sort_values("N_Both", ascending=False)
+        .reset_index(drop=True)
+    )
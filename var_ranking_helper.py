@@ -6,6 +6,26 @@ from collections import defaultdict
 import re
 from tqdm import tqdm
 from copy import deepcopy
+from contextlib import contextmanager
+
+
+# When True, feature functions use the original pure-Python loops. These are kept
+# as the ground truth that the vectorized paths are checked against
+REFERENCE_MODE = False
+
+
+@contextmanager
+def reference_mode(enabled=True):
+    """
+    Temporarily switch feature calculations to (or away from) the reference loops
+    """
+    global REFERENCE_MODE
+    previous = REFERENCE_MODE
+    REFERENCE_MODE = enabled
+    try:
+        yield
+    finally:
+        REFERENCE_MODE = previous
 
 
 var_pat = re.compile("[A-z]([0-9]+)")
@@ -116,7 +136,14 @@ def split_mutstring(string):
     return [xx.strip() for xx in string.split(",") if xx.strip() and "X" not in xx]
 
 
-def count_variants_per_haplotype(df, pangolin_lineage):
+def count_variants_per_haplotype(df, pangolin_lineage, lineage_index=None):
+    """
+    Count the variants in a lineage. With a lineage_helper.LineageIndex, the
+    precomputed totals for the lineage and all of its descendants are returned
+    """
+    if lineage_index is not None:
+        return lineage_index.variant_counts(pangolin_lineage)
+
     # Subset to the lineage of interest
     df_hap = df[df["pango_lineage"] == pangolin_lineage]
 
@@ -128,12 +155,14 @@ def count_variants_per_haplotype(df, pangolin_lineage):
     return pd.Series(var_counts)
 
 
-def extend_VOCs(df: pd.DataFrame, VOCs: dict):
+def extend_VOCs(df: pd.DataFrame, VOCs: dict, lineage_index=None):
     """
     Pull in additional mutations that co-occur with the CDC variants of concern
     Args:
         df: the haplotype dataframe
         VOCs: a dictionary mapping CDC VOC pangolin lineages to a list of variants
+        lineage_index: optional lineage_helper.LineageIndex, to count each VOC
+            together with its descendant lineages
     """
 
     def sort_vars(x):
@@ -144,7 +173,7 @@ def extend_VOCs(df: pd.DataFrame, VOCs: dict):
 
     VOCs = deepcopy(VOCs)
     for vv in tqdm(VOCs):
-        var_counts = count_variants_per_haplotype(df, vv)
+        var_counts = count_variants_per_haplotype(df, vv, lineage_index=lineage_index)
 
         # Must occur at least 80% as often as the most common variant
         vars_tokeep = (
@@ -206,6 +235,13 @@ def nvariants_persite(df_before):
 
 
 def calculate_n_haplotypes_wherepresent(df):
+    if REFERENCE_MODE:
+        return _calculate_n_haplotypes_wherepresent_reference(df)
+    features = haplotype_features(df).rename_axis(None)
+    return tuple(features[cc] for cc in FEATURE_COLUMNS)
+
+
+def _calculate_n_haplotypes_wherepresent_reference(df):
     var_hap_obs = defaultdict(dict)
     country_counter = Counter()
     var_n_obs = Counter()
@@ -220,7 +256,7 @@ def calculate_n_haplotypes_wherepresent(df):
             variant = variant.strip()
 
             if (
-                variant[-1] == "_"
+                not variant or variant[-1] == "_"
             ):  # Skip the case where they didn't put in the mutation after the gene name
                 continue
 
@@ -256,6 +292,90 @@ def calculate_n_haplotypes_wherepresent(df):
     )
 
 
+FEATURE_COLUMNS = [
+    "Frac_HaplosWherePresent",
+    "N_Countries",
+    "Frac_Vars",
+    "RelFrac_Vars",
+    "VarsPerSite",
+    "NCounts",
+]
+
+
+def _explode_haplotypes(df):
+    """
+    Row position and stripped variant for every token of every haplotype
+    """
+    tokens = df["haplotype"].reset_index(drop=True).str.split(",").explode().str.strip()
+    # Skip the case where they didn't put in the mutation after the gene name
+    tokens = tokens[(tokens.str.len() > 0) & ~tokens.str.endswith("_").astype(bool)]
+    return tokens.index.to_numpy(), tokens.to_numpy(dtype=object)
+
+
+def haplotype_features(df, by=None):
+    """
+    Vectorized calculate_n_haplotypes_wherepresent, optionally computed separately
+    for every group of the `by` columns in a single pass
+    Returns a DataFrame of FEATURE_COLUMNS indexed by (*by, variant)
+    """
+    by = list(by or [])
+    group_cols = by or ["_all"]
+    df = df.reset_index(drop=True).assign(_all=0)
+
+    pos, variants = _explode_haplotypes(df)
+    tok = pd.DataFrame({cc: df[cc].to_numpy()[pos] for cc in group_cols})
+    tok["variant"] = variants
+    tok["_haplotype"] = df["haplotype"].to_numpy()[pos]
+    tok["_location"] = df["location"].to_numpy()[pos]
+    tok["_counts"] = df["haplotype_counts"].to_numpy()[pos]
+    gv = group_cols + ["variant"]
+
+    counts = tok.groupby(gv, sort=False)["_counts"].sum()
+    index = counts.index
+    group_index = index.droplevel("variant")
+
+    n_haplos = df.groupby(group_cols)["haplotype"].nunique()
+    n_present = tok.drop_duplicates(gv + ["_haplotype"]).groupby(gv, sort=False).size()
+    n_countries = (
+        (tok.groupby(gv + ["_location"], sort=False)["_counts"].sum() > 1)
+        .groupby(level=gv, sort=False)
+        .sum()
+    )
+
+    # collected_counts is repeated on every row of a location-month; keep the last
+    collected = df.drop_duplicates(
+        list(dict.fromkeys(group_cols + ["location", "monthdate"])), keep="last"
+    )
+    total_collected = collected.groupby(group_cols)["collected_counts"].sum()
+
+    sites = pd.Series(variants).drop_duplicates()
+    site_map = dict(zip(sites, [site_grouper(vv) for vv in sites]))
+    site_df = index.to_frame(index=False)
+    site_df["_site"] = site_df["variant"].map(site_map)
+    vars_persite = site_df.groupby(group_cols + ["_site"], sort=False)[
+        "variant"
+    ].transform("size")
+
+    features = pd.DataFrame(
+        {
+            "Frac_HaplosWherePresent": n_present.reindex(index).to_numpy()
+            / n_haplos.reindex(group_index).to_numpy(),
+            "N_Countries": n_countries.reindex(index).to_numpy(),
+            "Frac_Vars": counts.to_numpy()
+            / total_collected.reindex(group_index).to_numpy(),
+            "RelFrac_Vars": (
+                counts / counts.groupby(level=group_cols, sort=False).transform("sum")
+            ).to_numpy(),
+            "VarsPerSite": vars_persite.to_numpy(),
+            "NCounts": counts.to_numpy(),
+        },
+        index=index,
+    )
+    if not by:
+        features = features.droplevel("_all")
+    return features
+
+
 def calculate_epi_features(df):
     percent_haplos_present, countries, var_counts = calculate_n_haplotypes_wherepresent(
         df